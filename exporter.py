@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 import os
+import signal
 import sys
 import time
 import logging
-from threading import Thread
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import wraps
+from threading import Event, Thread
 
 import stripe
 from prometheus_client import Gauge, start_http_server
@@ -28,6 +32,29 @@ logger.info("Stripe SDK configured")
 # Stripe fee: percentage (e.g. 0.029 for 2.9%) and flat per-transaction (major units)
 FEE_PERCENT = float(os.getenv("STRIPE_FEE_PERCENT", "0.029"))
 FEE_FLAT = float(os.getenv("STRIPE_FEE_FLAT", "0.30"))
+# Derived once at import; the aggregation loops work in integer cents
+_FEE_MULTIPLIER = 1.0 - FEE_PERCENT
+_FEE_FLAT_CENTS = round(FEE_FLAT * 100)
+
+# ─── API Concurrency ───────────────────────────────────────────────────────────
+# Bounded pool for independent Stripe lookups; kept small to stay under rate limits
+_executor = ThreadPoolExecutor(max_workers=8)
+# The SDK's own retries (stripe.max_network_retries) cover connection errors,
+# 409s and 5xx, but only retry a 429 when Stripe sends Stripe-Should-Retry: true
+# (lock timeouts). Plain rate-limit 429s surface as RateLimitError, which is
+# what _retry_on_rate_limit handles; the two layers never retry the same 429
+# unless Stripe flags it, bounding that case to RATE_LIMIT_RETRIES x SDK retries.
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_BACKOFF = 1.0
+
+# Set on shutdown to stop the fetch loop and the main thread
+_stop = Event()
+
+# Product names change rarely; cache them process-wide as {product_id: (fetched_at, name)}
+PRODUCT_CACHE_TTL = 24 * 3600
+_product_cache = {}
+# Resolved plan names by price id, rebuilt every fetch cycle
+_plan_name_by_price_id = {}
 
 # ─── Prometheus Metrics ────────────────────────────────────────────────────────
 active_subs = Gauge(
@@ -95,19 +122,132 @@ revenue_net_24h_by_plan = Gauge(
     ["plan_name"],
 )
 
+# Bound set() methods of per-plan gauge children, keyed by (id(gauge), plan name)
+_setters = {}
+
 # ─── Helpers ───────────────────────────────────────────────────────────────────
+def _retry_on_rate_limit(fn):
+    """Wrap a Stripe API call to retry with exponential backoff when rate limited."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(RATE_LIMIT_RETRIES):
+            try:
+                return fn(*args, **kwargs)
+            except stripe.RateLimitError:
+                if attempt == RATE_LIMIT_RETRIES - 1:
+                    raise
+                delay = RATE_LIMIT_BACKOFF * 2 ** attempt
+                logger.warning("Stripe rate limit hit, retrying in %.1fs", delay)
+                if _stop.wait(delay):
+                    raise
+    return wrapper
+
+
+@_retry_on_rate_limit
+def _retrieve_product(product_id):
+    return stripe.Product.retrieve(product_id)
+
+
+@_retry_on_rate_limit
+def _invoices_paid_by(payment_intent_id):
+    """Return the invoices a PaymentIntent paid, via the invoice payments listing."""
+    payments = stripe.InvoicePayment.list(
+        payment={"type": "payment_intent", "payment_intent": payment_intent_id},
+        status="paid", limit=100,
+        expand=["data.invoice"]
+    ).auto_paging_iter()
+    return [p.invoice for p in payments]
+
+
+def _setter(gauge, name):
+    """Return the bound set() of the gauge's child for a plan, creating it on first use."""
+    key = (id(gauge), name)
+    setter = _setters.get(key)
+    if setter is None:
+        setter = gauge.labels(plan_name=name).set
+        _setters[key] = setter
+    return setter
+
+
+def _product_name(product_id):
+    """Return a product's name, served from the TTL cache when fresh."""
+    now = time.time()
+    entry = _product_cache.get(product_id)
+    if entry:
+        if now - entry[0] < PRODUCT_CACHE_TTL:
+            return entry[1]
+        # drop the stale entry so a deleted product doesn't linger if the retrieve fails
+        _product_cache.pop(product_id, None)
+    name = _retrieve_product(product_id).name
+    _product_cache[product_id] = (now, name)
+    return name
+
+
+def _prune_product_cache():
+    """Drop product names older than the cache TTL."""
+    cutoff = time.time() - PRODUCT_CACHE_TTL
+    for product_id, (fetched_at, _) in list(_product_cache.items()):
+        if fetched_at < cutoff:
+            _product_cache.pop(product_id, None)
+
+
+def _warm_product_names(product_ids):
+    """Fetch product names in parallel so later lookups are cache hits."""
+    futures = [
+        _executor.submit(_product_name, pid)
+        for pid in {pid for pid in product_ids if isinstance(pid, str)}
+    ]
+    for fut in as_completed(futures):
+        fut.result()
+
+
+def _resolve_plan_name(price):
+    """Return the price nickname, else its product name, else the price id."""
+    name = _plan_name_by_price_id.get(price.id)
+    if name:
+        return name
+    name = price.nickname
+    if not name:
+        product = price.product
+        if isinstance(product, str):
+            name = _product_name(product)
+        else:
+            name = getattr(product, "name", None)
+    name = name or price.id
+    _plan_name_by_price_id[price.id] = name
+    return name
+
+
+def _resolve_line_plan_name(price_details):
+    """Return the plan name already resolved for the line's price, else its product name."""
+    name = _plan_name_by_price_id.get(price_details.price)
+    if name:
+        return name
+    name = _product_name(price_details.product) or price_details.price
+    _plan_name_by_price_id[price_details.price] = name
+    return name
+
+
 def fetch_charge_metrics(window_seconds):
     """Fetch charges in last window, calculate gross, fees, and net."""
     cutoff = int(time.time()) - window_seconds
     charges = stripe.Charge.list(
         created={"gte": cutoff}, limit=100,
         expand=["data.balance_transaction"]
-    )
-    successes = [c for c in charges.data if c.paid and c.status == stripe.ChargeStatusSucceeded]
+    ).auto_paging_iter()
 
-    gross_cents = sum(c.amount for c in successes)
-    fees_cents = sum(c.balance_transaction.fee for c in successes)
-    net_cents = sum(c.balance_transaction.net for c in successes)
+    successes = []
+    gross_cents = 0
+    fees_cents = 0
+    net_cents = 0
+    for c in charges:
+        if not (c.paid and c.status == stripe.ChargeStatusSucceeded):
+            continue
+        successes.append(c)
+        bt = c.balance_transaction
+        gross_cents += c.amount
+        fees_cents += bt.fee
+        net_cents += bt.net
 
     payment_count_24h.set(len(successes))
     total_revenue_24h.set(gross_cents / 100.0)
@@ -118,102 +258,131 @@ def fetch_charge_metrics(window_seconds):
     return successes
 
 
+def fetch_plan_payment_metrics(successes):
+    """Break successful charges down by plan via their invoice lines."""
+    if not successes:
+        return
+
+    # charges don't reference invoices in the pinned API version, so map their
+    # payment intents to invoices through the invoice payments listing
+    futures = {
+        _executor.submit(_invoices_paid_by, pi_id): pi_id
+        for pi_id in {c.payment_intent for c in successes if c.payment_intent}
+    }
+    invoices_by_pi = {}
+    for fut in as_completed(futures):
+        invoices_by_pi[futures[fut]] = fut.result()
+
+    charge_lines = []
+    for c in successes:
+        for inv in invoices_by_pi.get(c.payment_intent, ()):
+            for line in inv.lines.data:
+                parent = line.parent
+                if not parent or parent.type != "subscription_item_details":
+                    continue
+                if line.pricing and line.pricing.price_details:
+                    charge_lines.append((c.balance_transaction, line))
+    _warm_product_names(
+        line.pricing.price_details.product for _, line in charge_lines
+        if line.pricing.price_details.price not in _plan_name_by_price_id
+    )
+
+    # plan_name -> [count, gross revenue cents, net revenue cents]
+    pay_plans = defaultdict(lambda: [0, 0, 0])
+    fee_percent, fee_flat_cents = FEE_PERCENT, _FEE_FLAT_CENTS
+    for bt, line in charge_lines:
+        qty = line.quantity or 1
+        plan_name = _resolve_line_plan_name(line.pricing.price_details)
+        gross = line.amount
+        fee = bt.fee if bt else round(gross * fee_percent) + fee_flat_cents
+        net = gross - fee
+        agg = pay_plans[plan_name]
+        agg[0] += qty
+        agg[1] += gross
+        agg[2] += net
+
+    for name, (cnt, gross, net) in pay_plans.items():
+        _setter(payment_count_24h_by_plan, name)(cnt)
+        _setter(revenue_24h_by_plan, name)(gross / 100.0)
+        _setter(revenue_net_24h_by_plan, name)(net / 100.0)
+
+
 def fetch_metrics():
     """Main loop: update all metrics every 5 minutes."""
-    while True:
+    while not _stop.is_set():
         logger.info("Starting metrics fetch cycle")
         try:
+            _plan_name_by_price_id.clear()
+            _prune_product_cache()
+
             # Subscriptions & plan breakdown
-            counts = {}
-            mrrs = {}
-            net_mrrs = {}
+            # plan_name -> [count, gross MRR cents, net MRR cents]
+            plans = defaultdict(lambda: [0, 0, 0])
+            fee_multiplier, fee_flat_cents = _FEE_MULTIPLIER, _FEE_FLAT_CENTS
             total_subs = 0
-            product_name_cache = {}
 
             subs_iter = stripe.Subscription.list(
                 status="active", limit=100,
                 expand=["data.items.data.price"]
             ).auto_paging_iter()
+            sub_items = []
             for s in subs_iter:
                 total_subs += 1
-                for item in s["items"].data:
-                    price = item.price
-                    plan_name = price.nickname or product_name_cache.setdefault(
-                        price.product,
-                        stripe.Product.retrieve(price.product).name
-                    ) or price.id
-                    qty = item.quantity or 1
-                    gross = (price.unit_amount or 0) * qty / 100.0
-                    # calculate net for MRR: gross minus percentage and flat fee
-                    net = gross * (1 - FEE_PERCENT) - FEE_FLAT * qty
-                    counts[plan_name] = counts.get(plan_name, 0) + qty
-                    mrrs[plan_name] = mrrs.get(plan_name, 0.0) + gross
-                    net_mrrs[plan_name] = net_mrrs.get(plan_name, 0.0) + net
+                # StripeObject is a dict, so s.items would be dict.items, not the field
+                items = s["items"]
+                if items:
+                    sub_items.extend(items.data)
+
+            _warm_product_names(
+                item.price.product for item in sub_items if not item.price.nickname
+            )
+
+            for item in sub_items:
+                price = item.price
+                unit_amount = price.unit_amount or 0
+                qty = item.quantity or 1
+                plan_name = _resolve_plan_name(price)
+                gross = unit_amount * qty
+                # calculate net for MRR: gross minus percentage and flat fee
+                net = round(gross * fee_multiplier) - fee_flat_cents * qty
+                agg = plans[plan_name]
+                agg[0] += qty
+                agg[1] += gross
+                agg[2] += net
 
             active_subs.set(total_subs)
-            for name, cnt in counts.items():
-                subs_count_by_plan.labels(plan_name=name).set(cnt)
-            for name, rev in mrrs.items():
-                subs_mrr_by_plan.labels(plan_name=name).set(rev)
-            for name, rev in net_mrrs.items():
-                subs_net_mrr_by_plan.labels(plan_name=name).set(rev)
-
-            # 24h charge metrics including fees and net
-            successes = fetch_charge_metrics(24 * 3600)
+            for name, (cnt, gross, net) in plans.items():
+                _setter(subs_count_by_plan, name)(cnt)
+                _setter(subs_mrr_by_plan, name)(gross / 100.0)
+                _setter(subs_net_mrr_by_plan, name)(net / 100.0)
 
-            # 24h-by-plan breakdown
-            pay_counts = {}
-            pay_revenues = {}
-            pay_net = {}
-            invoice_cache = {}
-            for c in successes:
-                if not c.invoice:
-                    continue
-                inv = invoice_cache.get(c.invoice) or stripe.Invoice.retrieve(
-                    c.invoice,
-                    expand=["lines.data.price", "lines.data.price.product", "payment_intent.payment_method_details.card.issuer"]
-                )
-                invoice_cache[c.invoice] = inv
-                for line in inv.lines.data:
-                    if line.type != stripe.InvoiceLineItemTypeSubscription:
-                        continue
-                    price = line.price
-                    plan_name = price.nickname or getattr(price.product, "name", None) or price.id
-                    qty = line.quantity or 1
-                    gross = (price.unit_amount or 0) * qty / 100.0
-                    # find corresponding charge for fee details
-                    bt = next(
-                        (c.balance_transaction for c in successes if c.invoice == inv.id),
-                        None
-                    )
-                    fee = bt.fee / 100.0 if bt else gross * FEE_PERCENT + FEE_FLAT
-                    net = gross - fee
-                    pay_counts[plan_name] = pay_counts.get(plan_name, 0) + qty
-                    pay_revenues[plan_name] = pay_revenues.get(plan_name, 0.0) + gross
-                    pay_net[plan_name] = pay_net.get(plan_name, 0.0) + net
-
-            for name, cnt in pay_counts.items():
-                payment_count_24h_by_plan.labels(plan_name=name).set(cnt)
-            for name, rev in pay_revenues.items():
-                revenue_24h_by_plan.labels(plan_name=name).set(rev)
-            for name, rev in pay_net.items():
-                revenue_net_24h_by_plan.labels(plan_name=name).set(rev)
+            # 24h charge metrics including fees and net, then by plan
+            successes = fetch_charge_metrics(24 * 3600)
+            # by-plan lookups fail independently so they can't hold up the totals
+            try:
+                fetch_plan_payment_metrics(successes)
+            except Exception:
+                logger.exception("Error during 24h-by-plan metrics fetch")
 
         except Exception:
             logger.exception("Error during metrics fetch")
 
-        time.sleep(300)
+        _stop.wait(300)
 
 
 def main():
+    signal.signal(signal.SIGTERM, lambda *_: _stop.set())
     # Bind to all interfaces so Docker port mapping works
     start_http_server(8080, addr="0.0.0.0")
     Thread(target=fetch_metrics, daemon=True).start()
     try:
-        while True:
-            time.sleep(3600)
+        while not _stop.is_set():
+            _stop.wait(3600)
+        logger.info("Shutting down on SIGTERM")
     except KeyboardInterrupt:
         logger.info("Shutting down on interrupt")
+        _stop.set()
+    _executor.shutdown(wait=False)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@
 
 import os
 import sys
+import threading
 import time
 import pytest
 from prometheus_client import REGISTRY
@@ -16,9 +17,10 @@ def setup_function(fn):
     os.environ["STRIPE_FEE_FLAT"] = "0.30"
     exporter.FEE_PERCENT = float(os.getenv("STRIPE_FEE_PERCENT"))
     exporter.FEE_FLAT = float(os.getenv("STRIPE_FEE_FLAT"))
+    exporter._FEE_MULTIPLIER = 1.0 - exporter.FEE_PERCENT
+    exporter._FEE_FLAT_CENTS = round(exporter.FEE_FLAT * 100)
     # define missing Stripe constants on the module
     setattr(exporter.stripe, "ChargeStatusSucceeded", "succeeded")
-    setattr(exporter.stripe, "InvoiceLineItemTypeSubscription", "subscription")
 
 
 # ─── Helpers ────────────────────────────────────────────────────────────────────
@@ -29,12 +31,12 @@ class DummyBalanceTx:
         self.net = net_cents
 
 class DummyCharge:
-    def __init__(self, amount_cents, fee_cents, net_cents, invoice_id=None):
+    def __init__(self, amount_cents, fee_cents, net_cents, payment_intent_id=None):
         self.amount = amount_cents
         self.paid = True
         self.status = exporter.stripe.ChargeStatusSucceeded
         self.balance_transaction = DummyBalanceTx(fee_cents, net_cents)
-        self.invoice = invoice_id
+        self.payment_intent = payment_intent_id
 
 class DummyList:
     def __init__(self, seq):
@@ -54,6 +56,20 @@ class DummyItem:
         self.price = price
         self.quantity = quantity
 
+class DummyLine:
+    def __init__(self, price_id, product_id, amount_cents, quantity=1,
+                 parent_type="subscription_item_details"):
+        self.amount = amount_cents
+        self.quantity = quantity
+        self.parent = type("Parent", (), {"type": parent_type})()
+        details = type("PD", (), {"price": price_id, "product": product_id})()
+        self.pricing = type("Pricing", (), {"price_details": details})()
+
+class DummyInvoice:
+    def __init__(self, id, lines):
+        self.id = id
+        self.lines = type("L", (), {"data": lines})()
+
 class DummySub:
     def __init__(self, items):
         self._items = items
@@ -75,7 +91,7 @@ def test_fetch_charge_metrics(monkeypatch):
     ]
     monkeypatch.setattr(
         exporter.stripe.Charge, "list",
-        lambda created, limit, expand: type("CL", (), {"data": charges})()
+        lambda created, limit, expand: DummyList(charges)
     )
 
     # Reset all 24h gauges
@@ -111,11 +127,10 @@ def test_fetch_metrics_subscriptions(monkeypatch):
     # 2) Stub out fetch_charge_metrics so we only test subscription logic
     monkeypatch.setattr(exporter, "fetch_charge_metrics", lambda ws: [])
 
-    # 3) Break out of the infinite loop after first iteration
-    monkeypatch.setattr(
-        exporter.time, "sleep",
-        lambda sec: (_ for _ in ()).throw(StopIteration)
-    )
+    # 3) Stop the loop after the first iteration
+    stop = threading.Event()
+    monkeypatch.setattr(exporter, "_stop", stop)
+    monkeypatch.setattr(stop, "wait", lambda timeout: stop.set())
 
     # Reset subscription-related gauges
     exporter.active_subs.set(0)
@@ -123,8 +138,7 @@ def test_fetch_metrics_subscriptions(monkeypatch):
     exporter.subs_mrr_by_plan.labels(plan_name="SubPlan").set(0)
     exporter.subs_net_mrr_by_plan.labels(plan_name="SubPlan").set(0)
 
-    with pytest.raises(StopIteration):
-        exporter.fetch_metrics()
+    exporter.fetch_metrics()
 
     # active_subs = 2 subscriptions total
     assert REGISTRY.get_sample_value("stripe_active_subscriptions") == 2.0
@@ -147,3 +161,240 @@ def test_fetch_metrics_subscriptions(monkeypatch):
         "stripe_net_subscription_mrr_by_plan", {"plan_name": "SubPlan"}
     ), rel=1e-6) == 2 * per_net
 
+
+
+# ─── Test fetch_metrics 24h-by-plan part ────────────────────────────────────────
+
+def _assert_valid_expand(resource, expand):
+    # every path must name a real expandable field and stay within Stripe's four levels
+    for path in expand:
+        parts = path.split(".")
+        assert parts[0] == "data" and len(parts) <= 4
+        assert parts[1] in resource.__annotations__, path
+
+
+def test_fetch_metrics_payments_by_plan(monkeypatch):
+    # One charge of 2 × 1500¢ whose payment intent paid a subscription invoice (fee 117¢)
+    price = DummyPrice(id="price_pay", unit_amount=1500, nickname="PayPlan")
+    invoice = DummyInvoice("in_1", [
+        DummyLine("price_pay", "prod_pay", 3000, quantity=2),
+        DummyLine("price_pay", "prod_pay", 7500, quantity=5, parent_type="invoice_item_details"),
+    ])
+    charges = [DummyCharge(3000, fee_cents=117, net_cents=2883, payment_intent_id="pi_1")]
+    monkeypatch.setattr(
+        exporter.stripe.Subscription, "list",
+        lambda status, limit, expand: DummyList([DummySub([DummyItem(price)])])
+    )
+    charge_expands = []
+    def charge_list(created, limit, expand):
+        charge_expands.append(expand)
+        return DummyList(charges)
+    monkeypatch.setattr(exporter.stripe.Charge, "list", charge_list)
+    payment_expands = []
+    def invoice_payment_list(payment, status, limit, expand):
+        payment_expands.append(expand)
+        assert payment == {"type": "payment_intent", "payment_intent": "pi_1"}
+        return DummyList([type("IP", (), {"invoice": invoice})()])
+    monkeypatch.setattr(exporter.stripe.InvoicePayment, "list", invoice_payment_list)
+
+    stop = threading.Event()
+    monkeypatch.setattr(exporter, "_stop", stop)
+    monkeypatch.setattr(stop, "wait", lambda timeout: stop.set())
+
+    exporter.fetch_metrics()
+
+    # only the subscription line counts, named after the subscription's price
+    assert REGISTRY.get_sample_value(
+        "stripe_successful_payments_last_24h_by_plan", {"plan_name": "PayPlan"}
+    ) == 2.0
+    assert pytest.approx(REGISTRY.get_sample_value(
+        "stripe_total_revenue_last_24h_by_plan", {"plan_name": "PayPlan"}
+    ), rel=1e-6) == 30.0
+    assert pytest.approx(REGISTRY.get_sample_value(
+        "stripe_net_revenue_last_24h_by_plan", {"plan_name": "PayPlan"}
+    ), rel=1e-6) == 30.0 - 1.17
+
+    assert charge_expands == [["data.balance_transaction"]]
+    _assert_valid_expand(exporter.stripe.Charge, charge_expands[0])
+    for expand in payment_expands:
+        _assert_valid_expand(exporter.stripe.InvoicePayment, expand)
+
+
+def test_fetch_plan_payment_metrics_looks_up_each_payment_intent_once(monkeypatch):
+    # Two charges on the same payment intent, one legacy charge without one
+    invoice = DummyInvoice("in_2", [DummyLine("price_new", "prod_new", 500)])
+    charges = [
+        DummyCharge(500, fee_cents=45, net_cents=455, payment_intent_id="pi_2"),
+        DummyCharge(500, fee_cents=45, net_cents=455, payment_intent_id="pi_2"),
+        DummyCharge(500, fee_cents=45, net_cents=455),
+    ]
+    looked_up = []
+    def invoice_payment_list(payment, status, limit, expand):
+        looked_up.append(payment["payment_intent"])
+        return DummyList([type("IP", (), {"invoice": invoice})()])
+    monkeypatch.setattr(exporter.stripe.InvoicePayment, "list", invoice_payment_list)
+    # price not seen on an active subscription, so fall back to the product name
+    monkeypatch.setattr(
+        exporter.stripe.Product, "retrieve",
+        lambda pid: type("P", (), {"name": "RetrievedPlan"})()
+    )
+    monkeypatch.setattr(exporter, "_product_cache", {})
+    exporter._plan_name_by_price_id.clear()
+
+    exporter.fetch_plan_payment_metrics(charges)
+
+    assert looked_up == ["pi_2"]
+    assert REGISTRY.get_sample_value(
+        "stripe_successful_payments_last_24h_by_plan", {"plan_name": "RetrievedPlan"}
+    ) == 2.0
+    assert pytest.approx(REGISTRY.get_sample_value(
+        "stripe_net_revenue_last_24h_by_plan", {"plan_name": "RetrievedPlan"}
+    ), rel=1e-6) == 2 * (5.0 - 0.45)
+
+
+def test_fetch_metrics_by_plan_failure_keeps_totals(monkeypatch, caplog):
+    charges = [DummyCharge(700, fee_cents=50, net_cents=650, payment_intent_id="pi_3")]
+    monkeypatch.setattr(
+        exporter.stripe.Subscription, "list",
+        lambda status, limit, expand: DummyList([])
+    )
+    monkeypatch.setattr(
+        exporter.stripe.Charge, "list",
+        lambda created, limit, expand: DummyList(charges)
+    )
+    def invoice_payment_list(**kwargs):
+        raise RuntimeError("invoice payments unavailable")
+    monkeypatch.setattr(exporter.stripe.InvoicePayment, "list", invoice_payment_list)
+
+    stop = threading.Event()
+    monkeypatch.setattr(exporter, "_stop", stop)
+    monkeypatch.setattr(stop, "wait", lambda timeout: stop.set())
+
+    exporter.fetch_metrics()
+
+    assert REGISTRY.get_sample_value("stripe_successful_payments_last_24h") == 1.0
+    assert pytest.approx(REGISTRY.get_sample_value("stripe_net_revenue_last_24h"), rel=1e-6) == 6.5
+    messages = [r.getMessage() for r in caplog.records]
+    assert "Error during 24h-by-plan metrics fetch" in messages
+    assert "Error during metrics fetch" not in messages
+
+
+# ─── Test rate-limit retries ────────────────────────────────────────────────────
+
+def _rate_limited(failures):
+    calls = []
+    def fn(*args, **kwargs):
+        calls.append((args, kwargs))
+        if len(calls) <= failures:
+            raise exporter.stripe.RateLimitError("rate limited")
+        return "ok"
+    return fn, calls
+
+
+def test_retry_on_rate_limit_recovers(monkeypatch):
+    stop = threading.Event()
+    delays = []
+    monkeypatch.setattr(exporter, "_stop", stop)
+    monkeypatch.setattr(stop, "wait", lambda timeout: delays.append(timeout) or False)
+    fn, calls = _rate_limited(failures=2)
+
+    assert exporter._retry_on_rate_limit(fn)("in_1", expand=["lines"]) == "ok"
+    assert len(calls) == 3
+    assert calls[-1] == (("in_1",), {"expand": ["lines"]})
+    # exponential backoff between attempts
+    assert delays == [exporter.RATE_LIMIT_BACKOFF, exporter.RATE_LIMIT_BACKOFF * 2]
+
+
+def test_retry_on_rate_limit_gives_up(monkeypatch):
+    stop = threading.Event()
+    monkeypatch.setattr(exporter, "_stop", stop)
+    monkeypatch.setattr(stop, "wait", lambda timeout: False)
+    fn, calls = _rate_limited(failures=exporter.RATE_LIMIT_RETRIES)
+
+    with pytest.raises(exporter.stripe.RateLimitError):
+        exporter._retry_on_rate_limit(fn)()
+    assert len(calls) == exporter.RATE_LIMIT_RETRIES
+
+
+def test_retry_on_rate_limit_stops_on_shutdown(monkeypatch):
+    stop = threading.Event()
+    stop.set()
+    monkeypatch.setattr(exporter, "_stop", stop)
+    fn, calls = _rate_limited(failures=1)
+
+    # shutdown during backoff re-raises instead of retrying
+    with pytest.raises(exporter.stripe.RateLimitError):
+        exporter._retry_on_rate_limit(fn)()
+    assert len(calls) == 1
+
+
+# ─── Test product name cache ────────────────────────────────────────────────────
+
+def test_product_name_ttl_cache(monkeypatch):
+    clock = [1_000_000.0]
+    retrieved = []
+    def product_retrieve(pid):
+        retrieved.append(pid)
+        return type("P", (), {"name": "Product %d" % len(retrieved)})()
+    monkeypatch.setattr(exporter.time, "time", lambda: clock[0])
+    monkeypatch.setattr(exporter.stripe.Product, "retrieve", product_retrieve)
+    monkeypatch.setattr(exporter, "_product_cache", {})
+
+    assert exporter._product_name("prod_1") == "Product 1"
+    # fresh entry is served from the cache
+    clock[0] += exporter.PRODUCT_CACHE_TTL - 1
+    assert exporter._product_name("prod_1") == "Product 1"
+    assert retrieved == ["prod_1"]
+
+    # expired entry is fetched again
+    clock[0] += 2
+    assert exporter._product_name("prod_1") == "Product 2"
+    assert retrieved == ["prod_1", "prod_1"]
+
+
+def test_prune_product_cache(monkeypatch):
+    now = 1_000_000.0
+    monkeypatch.setattr(exporter.time, "time", lambda: now)
+    monkeypatch.setattr(exporter, "_product_cache", {
+        "prod_fresh": (now - 60, "Fresh"),
+        "prod_stale": (now - exporter.PRODUCT_CACHE_TTL - 1, "Deleted"),
+    })
+
+    exporter._prune_product_cache()
+
+    assert exporter._product_cache == {"prod_fresh": (now - 60, "Fresh")}
+
+
+# ─── Test main shutdown ─────────────────────────────────────────────────────────
+
+class DummyExecutor:
+    def __init__(self):
+        self.shutdown_calls = []
+    def shutdown(self, wait=True):
+        self.shutdown_calls.append(wait)
+
+def test_main_exits_on_sigterm(monkeypatch):
+    handlers = {}
+    started = []
+    monkeypatch.setattr(exporter.signal, "signal", lambda sig, handler: handlers.setdefault(sig, handler))
+    monkeypatch.setattr(exporter, "start_http_server", lambda port, addr: None)
+    monkeypatch.setattr(
+        exporter, "Thread",
+        lambda target, daemon: type("T", (), {"start": lambda self: started.append(target)})()
+    )
+    executor = DummyExecutor()
+    monkeypatch.setattr(exporter, "_executor", executor)
+
+    # deliver SIGTERM while the main thread is waiting
+    stop = threading.Event()
+    monkeypatch.setattr(exporter, "_stop", stop)
+    monkeypatch.setattr(
+        stop, "wait",
+        lambda timeout: handlers[exporter.signal.SIGTERM](exporter.signal.SIGTERM, None)
+    )
+
+    exporter.main()
+
+    assert started == [exporter.fetch_metrics]
+    assert stop.is_set()
+    assert executor.shutdown_calls == [False]